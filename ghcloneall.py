@@ -9,9 +9,11 @@ import os
 import subprocess
 import sys
 import threading
+from bisect import bisect_left
 from concurrent import futures
 from configparser import ConfigParser
 from operator import attrgetter
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
 import requests_cache
@@ -26,23 +28,61 @@ __version__ = '1.12.1.dev0'
 CONFIG_FILE = '.ghcloneallrc'
 CONFIG_SECTION = 'ghcloneall'
 
+# ssh expands %C to a hash of the connection parameters
+SSH_CONTROL_PATH = '~/.ssh/ghcloneall-%C'
+
 
 USER_AGENT = 'ghcloneall/%s (using %s)' % (
     __version__, requests.utils.default_user_agent(),
 )
 
 
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# %s is either 'user' or 'organization'
+GRAPHQL_REPOS_QUERY = '''
+query($login: String!, $cursor: String) {
+  %s(login: $login) {
+    repositories(first: 100, after: $cursor, ownerAffiliations: OWNER,
+                 orderBy: {field: NAME, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name sshUrl url isArchived isFork isPrivate isDisabled
+        defaultBranchRef { name }
+      }
+    }
+  }
+}
+'''
+
+
 class Error(Exception):
     """An error that is not a bug in this script."""
 
 
+def make_session(token=None):
+    """Create a requests session for talking to the GitHub API.
+
+    Reusing the same session for all requests lets us reuse HTTP connections
+    instead of doing a new TLS handshake for every page.
+    """
+    session = requests.Session()
+    session.headers.update({
+        'user-agent': USER_AGENT,
+        'accept': 'application/vnd.github+json',
+    })
+    if token:
+        session.auth = ('', token)
+    return session
+
+
 def get_json_and_links(url, session=None):
     """Perform HTTP GET for a URL, return deserialized JSON and headers.
 
     Returns a tuple (json_data, links) where links is something dict-like.
     """
-    session = requests.Session() if session is None else session
-    r = session.get(url, headers={'user-agent': USER_AGENT})
+    session = make_session() if session is None else session
+    r = session.get(url)
     # When we get a JSON error response fron GitHub, we want to show that
     # message to the user instead of a traceback.  I expect it'll be something
     # like "rate limit exceeded, try again in N minutes".
@@ -54,29 +94,141 @@ def get_json_and_links(url, session=None):
     return r.json(), r.links
 
 
-def get_github_list(url, batch_size=100, progress_callback=None, session=None):
+def get_page_number(url):
+    """Return the page=N query parameter of a URL, or '' if there isn't one.
+
+    Some GitHub API endpoints paginate with opaque cursors instead of page
+    numbers.
+    """
+    return dict(parse_qsl(urlsplit(url).query)).get('page', '')
+
+
+def get_page_url(url, page):
+    """Return a copy of url with a different page=N query parameter."""
+    parts = urlsplit(url)
+    query = [(k, str(page) if k == 'page' else v)
+             for k, v in parse_qsl(parts.query)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def get_github_list(url, batch_size=100, progress_callback=None, session=None,
+                    concurrency=4):
     """Perform (a series of) HTTP GETs for a URL, return deserialized JSON.
 
     Format of the JSON is documented at
     http://developer.github.com/v3/repos/#list-organization-repositories
 
+    See iter_github_list() for details.
+    """
+    return list(iter_github_list(url, batch_size=batch_size,
+                                 progress_callback=progress_callback,
+                                 session=session, concurrency=concurrency))
+
+
+def iter_github_list(url, batch_size=100, progress_callback=None,
+                     session=None, concurrency=4):
+    """Perform (a series of) HTTP GETs for a URL, yield deserialized items.
+
     Supports batching (which GitHub indicates by the presence of a Link header,
     e.g. ::
 
         Link: <https://api.github.com/resource?page=2>; rel="next",
               <https://api.github.com/resource?page=5>; rel="last"
 
+    When the first page tells us the number of the last page, the remaining
+    pages are fetched concurrently, using up to ``concurrency`` threads
+    (unless ``concurrency`` is less than 2).  Items are yielded in order as
+    soon as their page arrives.
     """
-    session = requests.Session() if session is None else session
+    session = make_session() if session is None else session
     # API documented at http://developer.github.com/v3/#pagination
-    res, links = get_json_and_links('{}{}per_page={}'.format(
+    page, links = get_json_and_links('{}{}per_page={}'.format(
         url, '&' if '?' in url else '?', batch_size), session)
+    yield from page
+    n = len(page)
+    last_page = ''
+    if 'last' in links:
+        last_page = get_page_number(links['last']['url'])
+    if 'next' in links and last_page.isdigit() and concurrency > 1:
+        last_url = links['last']['url']
+        last_page = int(last_page)
+        page_urls = [get_page_url(last_url, page_no)
+                     for page_no in range(2, last_page + 1)]
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            pages = pool.map(
+                lambda page_url: get_json_and_links(page_url, session)[0],
+                page_urls)
+            for page in pages:
+                if progress_callback:
+                    progress_callback(n)
+                yield from page
+                n += len(page)
+        return
     while 'next' in links:
+        if progress_callback:
+            progress_callback(n)
+        page, links = get_json_and_links(links['next']['url'], session)
+        yield from page
+        n += len(page)
+
+
+def get_graphql_data(query, variables, session=None):
+    """Perform a GitHub GraphQL API query, return deserialized JSON data."""
+    session = make_session() if session is None else session
+    r = session.post(GRAPHQL_URL, json={'query': query,
+                                        'variables': variables})
+    if 400 <= r.status_code < 500:
+        raise Error("Failed to fetch {}:\n{}".format(
+            GRAPHQL_URL, r.json()['message']))
+    r.raise_for_status()
+    data = r.json()
+    if data.get('errors'):
+        raise Error("GitHub GraphQL query failed:\n{}".format(
+            '\n'.join(e['message'] for e in data['errors'])))
+    return data['data']
+
+
+def repo_from_graphql(node):
+    """Convert a GraphQL repository node to a REST-like repository dict.
+
+    Only the fields we actually use are included.
+    """
+    return {
+        'name': node['name'],
+        'ssh_url': node['sshUrl'],
+        'clone_url': node['url'] + '.git',
+        'default_branch': (node['defaultBranchRef'] or {}).get(
+            'name', 'master'),
+        'archived': node['isArchived'],
+        'fork': node['isFork'],
+        'private': node['isPrivate'],
+        'disabled': node['isDisabled'],
+    }
+
+
+def get_github_repos_graphql(owner, owner_type='user', progress_callback=None,
+                             session=None):
+    """Fetch the list of a user's or organization's repositories via GraphQL.
+
+    owner_type is either 'user' or 'organization'.
+
+    Returns a list of dicts in the same format as get_github_list() returns
+    for REST API repository listings, but containing only the fields we need.
+    GitHub requires authentication for all GraphQL queries.
+    """
+    query = GRAPHQL_REPOS_QUERY % owner_type
+    res = []
+    cursor = None
+    while True:
+        data = get_graphql_data(query, {'login': owner, 'cursor': cursor},
+                                session)
+        repos = data[owner_type]['repositories']
+        res.extend(map(repo_from_graphql, repos['nodes']))
+        if not repos['pageInfo']['hasNextPage']:
+            return res
         if progress_callback:
             progress_callback(len(res))
-        more, links = get_json_and_links(links['next']['url'], session)
-        res += more
-    return res
+        cursor = repos['pageInfo']['endCursor']
 
 
 def synchronized(method):
@@ -100,6 +252,7 @@ class Progress(object):
     - clear() clears the progress bar/status message
     - set_total(n) defines how many items there will be in total
     - item(text) shows an item and updates the progress bar
+    - skip(n) updates the progress bar as if n invisible items were shown
     - update(extra_text) updates the last item (and highlights it in a
       different color)
     - finish(msg) clear the progress bar/status message and print a summary
@@ -135,13 +288,13 @@ class Progress(object):
         """Replace the status message."""
         if self.finished:
             return
-        self.clear()
-        if message:
-            self.stream.write('\r')
-            self.stream.write(message)
-            self.stream.write('\r')
+        # Emit the erasure of the old message and the new message with a
+        # single write() to reduce flicker.
+        output = self.format_status(message)
+        if output:
+            self.stream.write(output)
             self.stream.flush()
-            self.last_status = message
+        self.last_status = message
 
     @synchronized
     def clear(self):
@@ -149,11 +302,21 @@ class Progress(object):
         if self.finished:
             return
         if self.last_status:
-            self.stream.write(
-                '\r{}\r'.format(' ' * len(self.last_status.rstrip())))
+            self.stream.write(self.format_clear())
             self.stream.flush()
             self.last_status = ''
 
+    def format_clear(self):
+        if not self.last_status:
+            return ''
+        return '\r{}\r'.format(' ' * len(self.last_status.rstrip()))
+
+    def format_status(self, message):
+        output = self.format_clear()
+        if message:
+            output += '\r{}\r'.format(message)
+        return output
+
     @synchronized
     def finish(self, msg=''):
         """Clear the status message and print a summary.
@@ -173,12 +336,9 @@ class Progress(object):
         return self.progress_bar_format.format(
             cur=cur, total=total, bar=self.bar(cur, total))
 
-    def scale(self, range, cur, total):
-        return range * cur // max(total, 1)
-
     def bar(self, cur, total):
-        n = min(self.scale(self.bar_width, cur, total), self.bar_width)
-        return (self.full_char * n).ljust(self.bar_width, self.empty_char)
+        n = min(self.bar_width * cur // max(total, 1), self.bar_width)
+        return self.full_char * n + self.empty_char * (self.bar_width - n)
 
     def set_limit(self, total):
         """Specify the expected total number of items.
@@ -189,6 +349,12 @@ class Progress(object):
         self.total = total
         self.progress()
 
+    @synchronized
+    def skip(self, n):
+        """Count n items as done without showing them."""
+        self.cur += n
+        self.progress()
+
     @synchronized
     def item(self, msg=''):
         """Show an item and update the progress bar."""
@@ -202,20 +368,29 @@ class Progress(object):
         return item
 
     @synchronized
-    def draw_item(self, item, prefix='', suffix='\n', flush=True):
+    def draw_item(self, item, prefix='', suffix='\n'):
         if self.finished:
             return
         if item.hidden:
             return
-        self.stream.write(''.join([
+        self.stream.write(self.format_item(item, prefix, suffix))
+        self.stream.flush()
+
+    def format_item(self, item, prefix='', suffix='\n'):
+        if item.hidden:
+            return ''
+        return ''.join([
             prefix,
             item.color,
             item.msg,
             item.reset,
             suffix,
-        ]))
-        if flush:
-            self.stream.flush()
+        ])
+
+    def format_extra_info(self, lines):
+        return ''.join(
+            ''.join([indent, color, line, reset, '\n'])
+            for indent, color, line, reset in lines)
 
     @synchronized
     def update_item(self, item):
@@ -255,19 +430,23 @@ class Progress(object):
         # corruption!
         item.extra_info_lines += lines
         n = sum(i.height for i in self.items[item.idx + 1:])
-        if n:
-            self.stream.write(self.t_cursor_up % n)
-        self.stream.write(self.t_insert_lines % len(lines))
-        for indent, color, line, reset in lines:
-            self.stream.write(''.join([indent, color, line, reset, '\n']))
+        output = [
+            self.t_cursor_up % n if n else '',
+            self.t_insert_lines % len(lines),
+            self.format_extra_info(lines),
+        ]
         # t_insert_lines may push the lines off the bottom of the screen,
         # so we need to redraw everything below the item we've updated
         # to be sure it's not gone.
         for i in self.items[item.idx + 1:]:
-            self.draw_item(i, flush=False)
-            for indent, color, line, reset in i.extra_info_lines:
-                self.stream.write(''.join([indent, color, line, reset, '\n']))
-        self.progress()
+            output.append(self.format_item(i))
+            output.append(self.format_extra_info(i.extra_info_lines))
+        # Redraw the progress bar in the same write().
+        bar = self.format_progress_bar(self.cur, self.total)
+        output.append(self.format_status(bar))
+        self.stream.write(''.join(output))
+        self.stream.flush()
+        self.last_status = bar
 
     class Item(object):
         def __init__(self, progress, msg, idx):
@@ -374,24 +553,65 @@ class Repo(object):
         return cls(gist['id'], gist['git_pull_url'], (gist['git_push_url'],))
 
 
+class RepoStatus(object):
+    """Working tree status, as reported by git status --porcelain=v2."""
+
+    def __init__(self, branch='', ahead=0, local_changes=False,
+                 staged_changes=False, unknown_files=()):
+        self.branch = branch
+        self.ahead = ahead
+        self.local_changes = local_changes
+        self.staged_changes = staged_changes
+        self.unknown_files = list(unknown_files)
+
+    @classmethod
+    def parse(cls, output):
+        """Parse the output of git status --porcelain=v2 --branch."""
+        status = cls()
+        for line in output.splitlines():
+            if line.startswith('# branch.head '):
+                status.branch = line[len('# branch.head '):]
+            elif line.startswith('# branch.ab '):
+                # +ahead -behind; we only care about unpushed commits
+                ahead = line[len('# branch.ab '):].split()[0]
+                status.ahead = int(ahead)
+            elif line.startswith(('1 ', '2 ')):
+                # the XY field shows staged (X) and unstaged (Y) changes
+                if line[2] != '.':
+                    status.staged_changes = True
+                if line[3] != '.':
+                    status.local_changes = True
+            elif line.startswith('u '):
+                # unmerged paths
+                status.staged_changes = True
+                status.local_changes = True
+            elif line.startswith('? '):
+                status.unknown_files.append(line[len('? '):])
+        return status
+
+
 class RepoWrangler(object):
 
     def __init__(self, dry_run=False, verbose=0, progress=None, quiet=False,
-                 token=None):
+                 token=None, partial_clone=False, shallow_clone=False,
+                 concurrency=4, ssh_command=None):
         self.n_repos = 0
         self.n_updated = 0
         self.n_new = 0
         self.n_dirty = 0
         self.dry_run = dry_run
+        self.partial_clone = partial_clone
+        self.shallow_clone = shallow_clone
+        self.concurrency = concurrency
+        self.ssh_command = ssh_command
         self.verbose = verbose or 0
         self.quiet = quiet
         self.progress = progress if progress else Progress()
         self.lock = threading.Lock()
+        self.existing_dirs = None
 
-        self.session = requests.Session()
+        self.session = make_session(token)
         self.has_auth_token = bool(token)
-        if token:
-            self.session.auth = ('', token)
 
     def get_github_list(self, list_url, message):
         self.progress.status(message)
@@ -399,8 +619,19 @@ class RepoWrangler(object):
         def progress_callback(n):
             self.progress.status("{} ({})".format(message, n))
 
-        return get_github_list(list_url, progress_callback=progress_callback,
-                               session=self.session)
+        return iter_github_list(list_url, progress_callback=progress_callback,
+                                session=self.session,
+                                concurrency=self.concurrency)
+
+    def get_github_repos_graphql(self, owner, owner_type, message):
+        self.progress.status(message)
+
+        def progress_callback(n):
+            self.progress.status("{} ({})".format(message, n))
+
+        return get_github_repos_graphql(owner, owner_type,
+                                        progress_callback=progress_callback,
+                                        session=self.session)
 
     def list_gists(self, user, pattern=None):
         list_url = 'https://api.github.com/users/{}/gists'.format(user)
@@ -425,7 +656,8 @@ class RepoWrangler(object):
 
     def list_repos(self, user=None, organization=None, pattern=None,
                    include_archived=False, include_forks=False,
-                   include_private=True, include_disabled=True):
+                   include_private=True, include_disabled=True,
+                   graphql=False):
 
         # User repositories default to sort=full_name, org repositories default
         # to sort=created.  In theory we don't care because we will sort the
@@ -437,12 +669,14 @@ class RepoWrangler(object):
 
         if organization and not user:
             owner = organization
+            owner_type = 'organization'
             list_url = ('https://api.github.com/orgs/{}/repos'
                         '?sort=full_name').format(
                             owner)
         elif user and not organization:
             owner = user
-            if include_private and self.has_auth_token:
+            owner_type = 'user'
+            if include_private and self.has_auth_token and not graphql:
                 self._verify_user_token(user)
                 # users/$name/repos does not include private repos, so
                 # we have to query for the repos owned by the current
@@ -459,7 +693,10 @@ class RepoWrangler(object):
         message = "Fetching list of {}'s repositories from GitHub...".format(
             owner)
 
-        repos = self.get_github_list(list_url, message)
+        if graphql:
+            repos = self.get_github_repos_graphql(owner, owner_type, message)
+        else:
+            repos = self.get_github_list(list_url, message)
         if not include_archived:
             repos = (r for r in repos if not r['archived'])
         if not include_forks:
@@ -475,6 +712,20 @@ class RepoWrangler(object):
             repos = (r for r in repos if fnmatch.fnmatch(r['name'], pattern))
         return sorted(map(Repo.from_repo, repos), key=attrgetter('name'))
 
+    @synchronized
+    def dir_exists(self, dir):
+        """Check if a subdirectory of the current working directory exists.
+
+        Lists the directory once instead of doing a stat() for every
+        existing repo.
+        """
+        if self.existing_dirs is None:
+            with os.scandir() as entries:
+                self.existing_dirs = {e.name for e in entries if e.is_dir()}
+        # On case-insensitive filesystems (Windows, macOS) a Foo/ checkout
+        # is also foo/, so we have to ask the filesystem about a miss.
+        return dir in self.existing_dirs or os.path.isdir(dir)
+
     def repo_task(self, repo):
         item = self.progress.item("+ {name}".format(name=repo.name))
         task = RepoTask(repo, item, self, self.task_finished)
@@ -508,36 +759,12 @@ class RepoTask(object):
     def decode(self, output):
         return output.decode('UTF-8', 'replace')
 
-    def branch_name(self, head):
-        if head.startswith('refs/'):
-            head = head[len('refs/'):]
-        if head.startswith('heads/'):
-            head = head[len('heads/'):]
-        return head
-
     def pretty_command(self, args):
         if self.options.verbose:
             return ' '.join(args)
         else:
             return ' '.join(args[:2])  # 'git diff' etc.
 
-    def call(self, args, **kwargs):
-        """Call a subprocess and return its exit code.
-
-        The subprocess is expected to produce no output.  If any output is
-        seen, it'll be displayed as an error.
-        """
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT, **kwargs)
-        output, _ = p.communicate()
-        retcode = p.wait()
-        if output:
-            self.progress_item.error_info(self.decode(output))
-            self.progress_item.error_info(
-                '{command} exited with {rc}'.format(
-                    command=self.pretty_command(args), rc=retcode))
-        return retcode
-
     def check_call(self, args, **kwargs):
         """Call a subprocess.
 
@@ -546,11 +773,13 @@ class RepoTask(object):
 
         The subprocess is expected to return exit code 0.  If it returns
         non-zero, that'll be displayed as an error.
+
+        Returns True if the subprocess succeeded.
         """
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT, **kwargs)
-        output, _ = p.communicate()
-        retcode = p.wait()
+        p = subprocess.run(args, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT, **kwargs)
+        output, retcode = p.stdout, p.returncode
         if retcode != 0:
             self.progress_item.update(' (failed)', failed=True)
         if output or retcode != 0:
@@ -558,6 +787,7 @@ class RepoTask(object):
             self.progress_item.error_info(
                 '{command} exited with {rc}'.format(
                     command=self.pretty_command(args), rc=retcode))
+        return retcode == 0
 
     def check_output(self, args, **kwargs):
         """Call a subprocess and return its standard output code.
@@ -568,10 +798,10 @@ class RepoTask(object):
         The subprocess is expected to return exit code 0.  If it returns
         non-zero, that'll be displayed as an error.
         """
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, **kwargs)
-        stdout, stderr = p.communicate()
-        retcode = p.wait()
+        p = subprocess.run(args, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, **kwargs)
+        stdout, stderr, retcode = p.stdout, p.stderr, p.returncode
         if stderr or retcode != 0:
             self.progress_item.error_info(self.decode(stderr))
             self.progress_item.error_info(
@@ -582,7 +812,7 @@ class RepoTask(object):
     def run(self):
         try:
             dir = self.repo_dir(self.repo)
-            if os.path.exists(dir):
+            if self.options.dir_exists(dir):
                 self.update(self.repo, dir)
                 self.verify(self.repo, dir)
             else:
@@ -606,33 +836,61 @@ class RepoTask(object):
         if self.finished_callback:
             self.finished_callback(self)
 
+    def git_env(self, dir=None):
+        """Return the environment for git commands that talk to GitHub.
+
+        Returns None (i.e. inherit ours) when we're not sharing the SSH
+        connection, or when the repository in dir has its own
+        core.sshCommand, e.g. to use a different SSH key.
+        """
+        if not self.options.ssh_command:
+            return None
+        if dir is not None and get_core_ssh_command(cwd=dir):
+            return None
+        return dict(os.environ, GIT_SSH_COMMAND=self.options.ssh_command)
+
     def clone(self, repo, dir):
         self.progress_item.update(' (new)')
         if not self.options.dry_run:
             url = self.repo_url(repo)
-            self.check_call(['git', 'clone', '-q', url])
+            args = ['git', 'clone', '-q']
+            if self.options.partial_clone:
+                # Download commits and trees, but fetch file contents only
+                # as needed.  All the history is still there for git log.
+                args.append('--filter=blob:none')
+            if self.options.shallow_clone:
+                # Only the latest commit of the default branch.  git pull
+                # will keep fetching new commits on top of it.
+                args.append('--depth=1')
+            args.append(url)
+            self.check_call(args, env=self.git_env())
         self.new = True
 
     def update(self, repo, dir):
         if not self.options.dry_run:
             old_sha = self.get_current_commit(dir)
-            self.check_call(['git', 'pull', '-q', '--ff-only'], cwd=dir)
+            # A failed --ff-only pull doesn't move HEAD, so there's no need
+            # to check it again.
+            if not self.check_call(['git', 'pull', '-q', '--ff-only'],
+                                   cwd=dir, env=self.git_env(dir)):
+                return
             new_sha = self.get_current_commit(dir)
             if old_sha != new_sha:
                 self.progress_item.update(' (updated)')
                 self.updated = True
 
     def verify(self, repo, dir):
-        if self.has_local_changes(dir):
+        status = self.get_status(dir)
+        if status.local_changes:
             self.progress_item.update(' (local changes)')
             self.dirty = True
-        if self.has_staged_changes(dir):
+        if status.staged_changes:
             self.progress_item.update(' (staged changes)')
             self.dirty = True
-        if self.has_local_commits(dir):
+        if status.ahead:
             self.progress_item.update(' (local commits)')
             self.dirty = True
-        branch = self.get_current_branch(dir)
+        branch = status.branch
         if branch != repo.default_branch:
             self.progress_item.update(' (not on {})'.format(
                 repo.default_branch))
@@ -656,7 +914,7 @@ class RepoTask(object):
                                 'alternatively: {}'.format(url))
                 self.dirty = True
         if self.options.verbose:
-            unknown_files = self.get_unknown_files(dir)
+            unknown_files = status.unknown_files
             if unknown_files:
                 self.progress_item.update(' (unknown files)')
                 if self.options.verbose >= 2:
@@ -667,41 +925,26 @@ class RepoTask(object):
                     self.progress_item.extra_info('\n'.join(unknown_files))
                 self.dirty = True
 
-    def has_local_changes(self, dir):
-        # command borrowed from /usr/lib/git-core/git-sh-prompt
-        return self.call(
-            ['git', 'diff', '--no-ext-diff', '--quiet', '--exit-code'],
-            cwd=dir) != 0
-
-    def has_staged_changes(self, dir):
-        # command borrowed from /usr/lib/git-core/git-sh-prompt
-        return self.call(
-            ['git', 'diff-index', '--cached', '--quiet', 'HEAD', '--'],
-            cwd=dir) != 0
-
-    def has_local_commits(self, dir):
-        return self.check_output(['git', 'rev-list', '@{u}..'], cwd=dir) != ''
+    def get_status(self, dir):
+        # One git status call tells us everything verify() needs to know
+        # except the remote URL.  Listing unknown files is slower, so we
+        # do that only when we're going to report them.
+        untracked = 'all' if self.options.verbose else 'no'
+        return RepoStatus.parse(self.check_output(
+            ['git', 'status', '--porcelain=v2', '--branch',
+             '--untracked-files=' + untracked], cwd=dir))
 
     def get_current_commit(self, dir):
-        return self.check_output(
-            ['git', 'describe', '--always', '--dirty'], cwd=dir)
-
-    def get_current_head(self, dir):
-        return self.check_output(
-            ['git', 'symbolic-ref', 'HEAD'], cwd=dir).strip()
-
-    def get_current_branch(self, dir):
-        return self.branch_name(self.get_current_head(dir))
+        # NB: not 'git describe --always --dirty', because checking for
+        # dirtiness means stat()ing every file in the working tree, and
+        # we only want to know whether git pull moved HEAD.
+        return self.check_output(['git', 'rev-parse', 'HEAD'], cwd=dir)
 
     def get_remote_url(self, dir):
+        # We cloned the repository, so the remote is called 'origin'.
+        # Reading the configuration is cheaper than git ls-remote --get-url.
         return self.check_output(
-            ['git', 'ls-remote', '--get-url'], cwd=dir).strip()
-
-    def get_unknown_files(self, dir):
-        # command borrowed from /usr/lib/git-core/git-sh-prompt
-        return self.check_output(
-            ['git', 'ls-files', '--others', '--exclude-standard', '--', ':/*'],
-            cwd=dir).splitlines()
+            ['git', 'config', '--get', 'remote.origin.url'], cwd=dir).strip()
 
 
 class SequentialJobQueue(object):
@@ -722,26 +965,23 @@ class SequentialJobQueue(object):
 class ConcurrentJobQueue(object):
 
     def __init__(self, concurrency=2):
-        self.jobs = set()
-        self.concurrency = concurrency
+        # add() blocks until a worker is free, so we don't queue up (and
+        # show progress items for) more tasks than we can run at once.
+        self.slots = threading.BoundedSemaphore(concurrency)
         self.pool = futures.ThreadPoolExecutor(
             max_workers=concurrency)
 
     def add(self, task):
         try:
-            while len(self.jobs) >= self.concurrency:
-                done, not_done = futures.wait(
-                    self.jobs, return_when=futures.FIRST_COMPLETED)
-                self.jobs.difference_update(done)
+            self.slots.acquire()
             future = self.pool.submit(task.run)
-            self.jobs.add(future)
+            future.add_done_callback(lambda future: self.slots.release())
         except KeyboardInterrupt:
             task.aborted()
             raise
 
     def finish(self):
         self.pool.shutdown()
-        self.jobs.clear()
 
     def __enter__(self):
         return self
@@ -750,15 +990,78 @@ class ConcurrentJobQueue(object):
         self.finish()
 
 
-def spawn_ssh_control_master():
+def spawn_ssh_control_master(control_path=None):
     # If the user has 'ControlMaster auto' in their ~/.ssh/config, one of the
     # git clone/pull commands we initiate will start a control master process
     # that will never exit, with its stdout/stderr pointing to our pipe, and
     # our p.communicate() will block forever.  So let's make sure there's a
     # control master process running before we start git clone/pull processes.
     # https://github.com/mgedmin/ghcloneall/issues/1
-    subprocess.Popen(['ssh', '-q', '-fN', '-M', '-o', 'ControlPersist=600',
-                      'git@github.com'])
+    options = ['-o', 'ControlPath=' + control_path] if control_path else []
+    # Thanks to ControlPersist the master from a previous run may still be
+    # around, in which case we can use it and skip the SSH handshake.
+    # Starting another one would fail to bind the control socket, and we'd
+    # be left with a pointless extra ssh connection idling in the
+    # background.
+    p = subprocess.run(['ssh', '-q', '-O', 'check'] + options
+                       + ['git@github.com'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if p.returncode == 0:
+        return
+    # ControlMaster=auto instead of -M: if a master was killed without
+    # cleaning up (kill -9, reboot), ssh -M would fail to bind the stale
+    # socket, silently disable multiplexing and linger as a plain
+    # connection, while auto unlinks the stale socket and becomes the master.
+    # ssh -f goes into the background only after authenticating, so waiting
+    # for it means the master is ready before any git command needs it.
+    # No pipes here: the backgrounded ssh keeps its stdout/stderr open.
+    args = ['ssh', '-q', '-fN', '-o', 'ControlMaster=auto',
+            '-o', 'ControlPersist=600']
+    subprocess.run(args + options + ['git@github.com'])
+
+
+def get_core_ssh_command(cwd=None):
+    """Return git's core.sshCommand setting, or '' if it isn't set.
+
+    When cwd is a git checkout, this includes the checkout's own .git/config
+    (and anything it pulls in with includeIf).
+    """
+    p = subprocess.run(['git', 'config', '--get', 'core.sshCommand'],
+                       cwd=cwd, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return p.stdout.decode('UTF-8', 'replace').strip()
+
+
+def get_git_ssh_command(environ=os.environ):
+    """Return a GIT_SSH_COMMAND that reuses our SSH control master.
+
+    Without this, every git clone/pull does its own SSH handshake, unless
+    the user has configured connection sharing in ~/.ssh/config.
+
+    Returns None if the user has their own ssh command configured for git,
+    or if we're on Windows.
+    """
+    if 'GIT_SSH' in environ or 'GIT_SSH_COMMAND' in environ:
+        return None
+    if sys.platform == 'win32':
+        # Win32-OpenSSH doesn't support connection sharing
+        return None
+    if get_core_ssh_command():
+        return None
+    # ControlMaster=no: use the master if it's there, but never become one,
+    # so we don't get https://github.com/mgedmin/ghcloneall/issues/1 either.
+    # BatchMode=yes: if there's no master (e.g. it failed to authenticate),
+    # fail instead of asking for a passphrase from N git processes at once.
+    return ('ssh -o BatchMode=yes -o ControlMaster=no -o ControlPath='
+            + SSH_CONTROL_PATH)
+
+
+def default_concurrency():
+    # git clone/pull mostly waits for the network, so we can run more of
+    # them than we have CPUs.  But all of them share a single SSH
+    # connection, and sshd by default allows only 10 sessions per connection
+    # (MaxSessions).
+    return min(max(4, (os.cpu_count() or 4) * 3 // 4), 8)
 
 
 def read_config_file(filename):
@@ -779,11 +1082,20 @@ def _main():
         '--version', action='version',
         version="%(prog)s version " + __version__)
     parser.add_argument(
-        '-c', '--concurrency', type=int, default=4,
-        help="set concurrency level (default: %(default)s)")
+        '-c', '-j', '--concurrency', type=int,
+        help="set concurrency level (default: 3/4 of the number of CPUs,"
+             " but at least 4 and at most 8)")
     parser.add_argument(
         '-n', '--dry-run', action='store_true',
         help="don't pull/clone, just print what would be done")
+    parser.add_argument(
+        '--partial', action='store_true',
+        help="make blobless clones of new repositories: file contents will"
+             " be downloaded on demand")
+    parser.add_argument(
+        '--shallow', action='store_true',
+        help="make shallow clones of new repositories: only the latest commit"
+             " will be downloaded")
     parser.add_argument(
         '-q', '--quiet', action='store_true',
         help="terser output")
@@ -841,15 +1153,21 @@ def _main():
     parser.add_argument(
         '--exclude-disabled', action='store_false', dest='include_disabled',
         help='exclude disabled repositories')
+    parser.add_argument(
+        '--graphql', action='store_true', default=None,
+        help='list repositories using the GitHub GraphQL API'
+             ' (requires a github token; ignored with --gists)')
+    parser.add_argument(
+        '--no-graphql', action='store_false', dest='graphql',
+        help='list repositories using the GitHub REST API (default)')
     parser.add_argument(
         '--init', action='store_true',
         help='create a {} from command-line arguments'.format(CONFIG_FILE))
     parser.add_argument(
         '--http-cache', default='.httpcache', metavar='DBNAME',
-        # .sqlite will be appended automatically by requests-cache < 0.6
-        # requests-cache >= 0.6 adds .sqlite only when the name has no .
-        help='cache HTTP requests on disk in an sqlite database for 5 minutes'
-             ' (default: .httpcache)')
+        # requests-cache adds .sqlite only when the name has no .
+        help='cache HTTP requests on disk in an sqlite database for 5 minutes,'
+             ' then revalidate them using ETags (default: .httpcache)')
     parser.add_argument(
         '--no-http-cache', action='store_false', dest='http_cache',
         help='disable HTTP disk caching')
@@ -886,6 +1204,9 @@ def _main():
         if config.has_option(CONFIG_SECTION, 'include_disabled'):
             args.include_disabled = config.getboolean(CONFIG_SECTION,
                                                       'include_disabled')
+    if args.graphql is None:
+        if config.has_option(CONFIG_SECTION, 'graphql'):
+            args.graphql = config.getboolean(CONFIG_SECTION, 'graphql')
 
     if args.user and args.organization:
         parser.error(
@@ -896,6 +1217,9 @@ def _main():
     if args.gists and not args.user:
         parser.error(
             "Please specify --user, not --organization, when using --gists")
+    if args.graphql and not args.gists and not args.github_token:
+        parser.error(
+            "Please specify a GitHub token when using --graphql")
 
     if args.init:
         config.remove_section(CONFIG_SECTION)
@@ -922,6 +1246,8 @@ def _main():
         if args.include_disabled is not None:
             config.set(CONFIG_SECTION, 'include_disabled',
                        str(args.include_disabled))
+        if args.graphql is not None:
+            config.set(CONFIG_SECTION, 'graphql', str(args.graphql))
         if not args.dry_run:
             write_config_file(CONFIG_FILE, config)
             print("Wrote {}".format(CONFIG_FILE))
@@ -931,6 +1257,8 @@ def _main():
                     CONFIG_FILE))
         return
 
+    if args.concurrency is None:
+        args.concurrency = default_concurrency()
     if args.include_private and not args.github_token:
         print('Warning: Listing private repositories requires a GitHub token',
               file=sys.stderr)
@@ -941,16 +1269,28 @@ def _main():
         args.include_disabled = True
 
     if args.http_cache:
+        # Once a cached response expires, requests-cache will send a
+        # conditional request with If-None-Match: <etag>, and GitHub will
+        # reply with a body-less 304 Not Modified if nothing changed.  These
+        # don't count against the API rate limit either.
         requests_cache.install_cache(args.http_cache,
                                      backend='sqlite',
                                      expire_after=300)
 
-    spawn_ssh_control_master()
+    # Nobody is going to answer a username/password prompt from one of our
+    # background git processes, and it would hang that worker forever.
+    os.environ.setdefault('GIT_TERMINAL_PROMPT', '0')
+    ssh_command = get_git_ssh_command()
+    spawn_ssh_control_master(SSH_CONTROL_PATH if ssh_command else None)
 
     with Progress() as progress:
         wrangler = RepoWrangler(dry_run=args.dry_run, verbose=args.verbose,
                                 progress=progress, quiet=args.quiet,
-                                token=args.github_token)
+                                token=args.github_token,
+                                partial_clone=args.partial,
+                                shallow_clone=args.shallow,
+                                concurrency=args.concurrency,
+                                ssh_command=ssh_command)
         if args.gists:
             repos = wrangler.list_gists(
                 user=args.user,
@@ -965,17 +1305,20 @@ def _main():
                 include_archived=args.include_archived,
                 include_private=args.include_private,
                 include_disabled=args.include_disabled,
+                graphql=args.graphql,
             )
         progress.set_limit(len(repos))
+        if args.start_from:
+            # repos are sorted by name, so the ones we skip are a prefix
+            start = bisect_left([repo.name for repo in repos], args.start_from)
+            progress.skip(start)
+            repos = repos[start:]
         if args.concurrency < 2:
             queue = SequentialJobQueue()
         else:
             queue = ConcurrentJobQueue(args.concurrency)
         with queue:
             for repo in repos:
-                if args.start_from and repo.name < args.start_from:
-                    progress.item()
-                    continue
                 task = wrangler.repo_task(repo)
                 queue.add(task)
         progress.finish(
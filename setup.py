@@ -51,7 +51,7 @@ setup(
     python_requires=">=3.7",
     install_requires=[
         'requests',
-        'requests_cache',
+        'requests_cache >= 0.7',
     ],
     entry_points={
         'console_scripts': [
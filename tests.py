@@ -52,7 +52,7 @@ class MockRequestGet:
                 json={'login': user},
             )
 
-    def __call__(self, url, headers=None):
+    def __call__(self, url):
         return self.responses.get(url, self.not_found)
 
 
@@ -65,6 +65,30 @@ def mock_requests_get(monkeypatch):
     return mock_get
 
 
+class MockRequestPost:
+
+    def __init__(self):
+        self.responses = {}
+        self.not_found = MockResponse(
+            status_code=401, json={'message': 'requires authentication'},
+        )
+
+    def update(self, responses):
+        self.responses.update(responses)
+
+    def __call__(self, url, json=None):
+        assert url == 'https://api.github.com/graphql'
+        key = (json['variables']['login'], json['variables']['cursor'])
+        return self.responses.get(key, self.not_found)
+
+
+@pytest.fixture(autouse=True)
+def mock_requests_post(monkeypatch):
+    mock_post = MockRequestPost()
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+    return mock_post
+
+
 @pytest.fixture(autouse=True)
 def mock_requests_cache(monkeypatch):
     monkeypatch.setattr(requests_cache, 'install_cache', lambda *a, **kw: None)
@@ -75,8 +99,13 @@ class MockPopen:
         self.stdout = stdout
         self.stderr = stderr
         self.rc = rc
+        self.commands = []
+        self.envs = []
 
-    def __call__(self, args, stdout=None, stderr=None, cwd=None):
+    def __call__(self, args, stdout=None, stderr=None, cwd=None, env=None,
+                 **kwargs):
+        self.commands.append(args)
+        self.envs.append(env)
         new_stdout = self.stdout
         new_stderr = self.stderr
         if stderr == subprocess.STDOUT:
@@ -86,14 +115,24 @@ class MockPopen:
             new_stderr = None
         if stdout != subprocess.PIPE:
             new_stdout = None
-        return MockPopen(new_stdout, new_stderr, self.rc)
+        p = MockPopen(new_stdout, new_stderr, self.rc)
+        p.args = args
+        return p
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
 
-    def communicate(self):
+    def communicate(self, input=None, timeout=None):
         return self.stdout, self.stderr
 
-    def wait(self):
+    def wait(self, timeout=None):
         return self.rc
 
+    poll = wait
+
 
 @pytest.fixture(autouse=True)
 def mock_subprocess_Popen(monkeypatch):
@@ -102,6 +141,17 @@ def mock_subprocess_Popen(monkeypatch):
     return mock_Popen
 
 
+@pytest.fixture(autouse=True)
+def isolated_environment(monkeypatch):
+    # The user's own GIT_SSH[_COMMAND] would change what we do, and _main()
+    # sets GIT_TERMINAL_PROMPT; this makes sure they get restored afterwards.
+    # delenv() of a variable that isn't set records nothing to undo, hence
+    # the setenv() first.
+    for name in ['GIT_SSH_COMMAND', 'GIT_SSH', 'GIT_TERMINAL_PROMPT']:
+        monkeypatch.setenv(name, 'x')
+        monkeypatch.delenv(name)
+
+
 @pytest.fixture(autouse=True)
 def mock_config_filename(monkeypatch):
     monkeypatch.setattr(ghcloneall, 'CONFIG_FILE', '/dev/null')
@@ -128,10 +178,33 @@ def mock_multi_page_api_responses(url, pages, extra='sort=full_name&'):
         if n != len(pages):
             next_page_url = make_page_url(url, n + 1, extra)
             links['next'] = next_page_url
+            links['last'] = make_page_url(url, len(pages), extra)
         responses[page_url] = MockResponse(json=page, links=links)
     return responses
 
 
+def mock_graphql_responses(owner, owner_type, pages):
+    assert len(pages) > 0
+    responses = {}
+    for n, page in enumerate(pages, 1):
+        cursor = None if n == 1 else 'cursor%d' % n
+        has_next = n != len(pages)
+        responses[owner, cursor] = MockResponse(json={
+            'data': {
+                owner_type: {
+                    'repositories': {
+                        'pageInfo': {
+                            'hasNextPage': has_next,
+                            'endCursor': 'cursor%d' % (n + 1),
+                        },
+                        'nodes': page,
+                    },
+                },
+            },
+        })
+    return responses
+
+
 class Terminal:
 
     def __init__(self, width=80, height=24):
@@ -293,6 +366,154 @@ def test_get_github_list(mock_requests_get):
     assert progress == [2, 4]
 
 
+def test_get_github_list_concurrent(mock_requests_get):
+    mock_requests_get.update(mock_multi_page_api_responses(
+        url='https://github.example.com/api',
+        extra='',
+        pages=[
+            [{'item': 1}, {'item': 2}],
+            [{'item': 3}, {'item': 4}],
+            [{'item': 5}],
+        ],
+    ))
+    url = 'https://github.example.com/api'
+    progress = []
+    res = ghcloneall.get_github_list(url, progress_callback=progress.append)
+    assert res == [
+        {'item': 1},
+        {'item': 2},
+        {'item': 3},
+        {'item': 4},
+        {'item': 5},
+    ]
+    assert progress == [2, 4]
+
+
+def test_get_github_list_no_concurrency(monkeypatch, mock_requests_get):
+    # --concurrency=1 means one API request at a time
+    monkeypatch.setattr(ghcloneall.futures, 'ThreadPoolExecutor', None)
+    mock_requests_get.update(mock_multi_page_api_responses(
+        url='https://github.example.com/api',
+        extra='',
+        pages=[
+            [{'item': 1}, {'item': 2}],
+            [{'item': 3}],
+        ],
+    ))
+    url = 'https://github.example.com/api'
+    res = ghcloneall.get_github_list(url, concurrency=1)
+    assert res == [
+        {'item': 1},
+        {'item': 2},
+        {'item': 3},
+    ]
+
+
+def test_get_github_list_cursor_pagination(mock_requests_get):
+    # rel="last" without a page number: fall back to following rel="next"
+    mock_requests_get.update({
+        'https://github.example.com/api?per_page=100': MockResponse(
+            json=[{'item': 1}, {'item': 2}],
+            links={
+                'next': 'https://github.example.com/api?after=abc'
+                        '&per_page=100',
+                'last': 'https://github.example.com/api?before=xyz'
+                        '&per_page=100',
+            }),
+        'https://github.example.com/api?after=abc&per_page=100': MockResponse(
+            json=[{'item': 3}]),
+    })
+    url = 'https://github.example.com/api'
+    res = ghcloneall.get_github_list(url)
+    assert res == [
+        {'item': 1},
+        {'item': 2},
+        {'item': 3},
+    ]
+
+
+def test_get_page_number():
+    assert ghcloneall.get_page_number(
+        'https://api.github.com/user/repos?page=5&per_page=9') == '5'
+    assert ghcloneall.get_page_number(
+        'https://api.github.com/user/repos?before=xyz') == ''
+
+
+def test_get_page_url():
+    url = 'https://api.github.com/user/repos?sort=full_name&page=5&per_page=9'
+    assert ghcloneall.get_page_url(url, 2) == (
+        'https://api.github.com/user/repos?sort=full_name&page=2&per_page=9'
+    )
+
+
+def test_get_graphql_data(mock_requests_post):
+    mock_requests_post.update({
+        ('test_user', None): MockResponse(json={'data': {'user': None}}),
+    })
+    data = ghcloneall.get_graphql_data(
+        'query', {'login': 'test_user', 'cursor': None})
+    assert data == {'user': None}
+
+
+def test_get_graphql_data_failure(mock_requests_post):
+    with pytest.raises(ghcloneall.Error) as ctx:
+        ghcloneall.get_graphql_data(
+            'query', {'login': 'test_user', 'cursor': None})
+    assert str(ctx.value) == (
+        'Failed to fetch https://api.github.com/graphql:\n'
+        'requires authentication'
+    )
+
+
+def test_get_graphql_data_query_errors(mock_requests_post):
+    mock_requests_post.update({
+        ('nobody', None): MockResponse(json={
+            'data': {'user': None},
+            'errors': [
+                {'message': "Could not resolve to a User"},
+            ],
+        }),
+    })
+    with pytest.raises(ghcloneall.Error) as ctx:
+        ghcloneall.get_graphql_data(
+            'query', {'login': 'nobody', 'cursor': None})
+    assert str(ctx.value) == (
+        'GitHub GraphQL query failed:\n'
+        'Could not resolve to a User'
+    )
+
+
+def test_repo_from_graphql():
+    assert ghcloneall.repo_from_graphql(graphql_repo('xyzzy')) == (
+        graphql_repo_as_rest('xyzzy')
+    )
+
+
+def test_repo_from_graphql_empty_repo():
+    node = graphql_repo('xyzzy', defaultBranchRef=None)
+    assert ghcloneall.repo_from_graphql(node)['default_branch'] == 'master'
+
+
+def test_get_github_repos_graphql(mock_requests_post):
+    mock_requests_post.update(mock_graphql_responses(
+        owner='test_org',
+        owner_type='organization',
+        pages=[
+            [graphql_repo('a'), graphql_repo('b')],
+            [graphql_repo('c')],
+        ],
+    ))
+    progress = []
+    res = ghcloneall.get_github_repos_graphql(
+        'test_org', 'organization', progress_callback=progress.append)
+    assert res == [
+        graphql_repo_as_rest('a'),
+        graphql_repo_as_rest('b'),
+        graphql_repo_as_rest('c'),
+    ]
+    assert progress == [2]
+
+
 def test_Progress(capsys):
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
@@ -355,6 +576,16 @@ def test_Progress_progress(capsys):
     )
 
 
+def test_Progress_skip(capsys):
+    buf = StringIO()
+    progress = ghcloneall.Progress(stream=buf)
+    progress.set_limit(4)
+    progress.skip(3)
+    assert show_ansi_result(buf.getvalue()) == (
+        '[###############.....] 3/4'
+    )
+
+
 def test_Progress_context_manager(capsys):
     buf = StringIO()
     with pytest.raises(KeyboardInterrupt):
@@ -507,6 +738,24 @@ def test_Progress_extra_info(capsys):
     )
 
 
+class WriteCountingStream(StringIO):
+    writes = 0
+
+    def write(self, s):
+        self.writes += 1
+        return super().write(s)
+
+
+def test_Progress_extra_info_single_write(capsys):
+    buf = WriteCountingStream()
+    progress = ghcloneall.Progress(stream=buf)
+    item = progress.item("first repo")
+    progress.item("second repo")
+    buf.writes = 0
+    item.extra_info("this is a very good repo btw\nand it has two lines")
+    assert buf.writes == 1
+
+
 def test_Progress_error_info(capsys):
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
@@ -672,6 +921,22 @@ def test_Progress_extra_info_not_last_item_redraws_all_below(capsys):
     )
 
 
+def test_Progress_extra_info_skips_hidden_items(capsys):
+    buf = StringIO()
+    progress = ghcloneall.Progress(stream=buf)
+    item1 = progress.item("first repo")
+    item2 = progress.item("second repo")
+    item2.finished(hide=True)
+    progress.item("third repo")
+    item1.extra_info("wow such magic")
+    assert show_ansi_result(buf.getvalue()) == (
+        'first repo\n'
+        '    wow such magic\n'
+        'third repo\n'
+        '[####################] 3/0'
+    )
+
+
 def test_Repo():
     r1 = ghcloneall.Repo('foo', 'git@github.com:test_user/foo.git',
                          ['https://github.com/test_user/foo'])
@@ -707,6 +972,13 @@ def Gist(name, **kwargs):
     return ghcloneall.Repo.from_gist(gist(name, **kwargs))
 
 
+def test_make_session():
+    session = ghcloneall.make_session()
+    assert session.headers['User-Agent'] == ghcloneall.USER_AGENT
+    assert session.headers['Accept'] == 'application/vnd.github+json'
+    assert session.auth is None
+
+
 def test_RepoWrangler_auth():
     token = 'UNITTEST'
     wrangler = ghcloneall.RepoWrangler(token=token)
@@ -769,6 +1041,31 @@ def Repo(name, **kwargs):
     return ghcloneall.Repo.from_repo(repo(name, **kwargs))
 
 
+def graphql_repo(name, **kwargs):
+    repo = {
+        'name': name,
+        'isArchived': False,
+        'isFork': False,
+        'isPrivate': False,
+        'isDisabled': False,
+        'url': 'https://github.com/test_user/%s' % name,
+        'sshUrl': 'git@github.com:test_user/%s.git' % name,
+        'defaultBranchRef': {'name': 'master'},
+    }
+    repo.update(kwargs)
+    return repo
+
+
+def graphql_repo_as_rest(name, **kwargs):
+    # GraphQL gives us no clone_url, we have to construct it
+    return repo(name, clone_url='https://github.com/test_user/%s.git' % name,
+                **kwargs)
+
+
+def GraphQLRepo(name, **kwargs):
+    return ghcloneall.Repo.from_repo(graphql_repo_as_rest(name, **kwargs))
+
+
 def test_RepoWrangler_list_repos_for_user(mock_requests_get):
     mock_requests_get.update(mock_multi_page_api_responses(
         url='https://api.github.com/users/test_user/repos',
@@ -803,6 +1100,53 @@ def test_RepoWrangler_list_repos_for_org(mock_requests_get):
     ]
 
 
+def test_RepoWrangler_list_repos_graphql(mock_requests_post):
+    mock_requests_post.update(mock_graphql_responses(
+        owner='test_user',
+        owner_type='user',
+        pages=[
+            [
+                graphql_repo('project-foo'),
+                graphql_repo('xyzzy', isFork=True),
+            ],
+        ],
+    ))
+    wrangler = ghcloneall.RepoWrangler(token='UNITTEST')
+    result = wrangler.list_repos(user='test_user', graphql=True)
+    assert result == [
+        GraphQLRepo('project-foo'),
+    ]
+
+
+def test_RepoWrangler_list_repos_graphql_progress_bar(mock_requests_post):
+    mock_requests_post.update(mock_graphql_responses(
+        owner='test_org',
+        owner_type='organization',
+        pages=[
+            [
+                graphql_repo('project-foo'),
+            ],
+            [
+                graphql_repo('xyzzy'),
+            ],
+        ],
+    ))
+    buf = StringIO()
+    progress = ghcloneall.Progress(stream=buf)
+    wrangler = ghcloneall.RepoWrangler(progress=progress, token='UNITTEST')
+    result = wrangler.list_repos(organization='test_org', graphql=True)
+    assert result == [
+        GraphQLRepo('project-foo'),
+        GraphQLRepo('xyzzy'),
+    ]
+    compare(
+        buf.getvalue(),
+        "{cr}Fetching list of test_org's repositories from GitHub...{cr}"
+        "{cr}                                                       {cr}"
+        "{cr}Fetching list of test_org's repositories from GitHub... (1){cr}"
+    )
+
+
 def test_RepoWrangler_list_repos_filter_by_name(mock_requests_get):
     mock_requests_get.update(mock_multi_page_api_responses(
         url='https://api.github.com/users/test_user/repos',
@@ -940,8 +1284,33 @@ def test_RepoWrangler_list_repos_missing_arguments():
         wrangler.list_repos()
 
 
+def test_RepoWrangler_dir_exists(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'xyzzy').mkdir()
+    (tmp_path / 'README').write_text(u'not a repository')
+    wrangler = ghcloneall.RepoWrangler()
+    assert wrangler.dir_exists('xyzzy')
+    assert not wrangler.dir_exists('README')
+    assert not wrangler.dir_exists('project-foo')
+    # a directory created after the listing was cached is still found
+    (tmp_path / 'project-foo').mkdir()
+    assert wrangler.dir_exists('project-foo')
+
+
+def test_RepoWrangler_dir_exists_case_insensitive(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'Xyzzy').mkdir()
+    # pretend we're on a case-insensitive filesystem
+    monkeypatch.setattr(os.path, 'isdir',
+                        lambda dir: dir.lower() == 'xyzzy')
+    wrangler = ghcloneall.RepoWrangler()
+    assert wrangler.dir_exists('xyzzy')
+    assert not wrangler.dir_exists('project-foo')
+
+
 def test_RepoWrangler_repo_task(monkeypatch):
-    monkeypatch.setattr(os.path, 'exists', lambda dir: False)
+    monkeypatch.setattr(ghcloneall.RepoWrangler, 'dir_exists',
+                        lambda self, dir: False)
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
@@ -962,15 +1331,73 @@ def test_RepoWrangler_repo_task(monkeypatch):
     assert wrangler.n_dirty == 0
 
 
+def test_RepoTask_git_env_no_ssh_sharing(mock_subprocess_Popen):
+    wrangler = ghcloneall.RepoWrangler()
+    task = wrangler.repo_task(Repo('xyzzy'))
+    assert task.git_env() is None
+    assert task.git_env('xyzzy') is None
+    assert mock_subprocess_Popen.commands == []
+
+
+def test_RepoTask_git_env(mock_subprocess_Popen):
+    wrangler = ghcloneall.RepoWrangler(ssh_command='ssh -o ControlMaster=no')
+    task = wrangler.repo_task(Repo('xyzzy'))
+    assert task.git_env()['GIT_SSH_COMMAND'] == 'ssh -o ControlMaster=no'
+    assert task.git_env('xyzzy')['GIT_SSH_COMMAND'] == (
+        'ssh -o ControlMaster=no'
+    )
+
+
+def test_RepoTask_git_env_repo_ssh_command(mock_subprocess_Popen):
+    # e.g. core.sshCommand in xyzzy/.git/config, or in a file included by
+    # includeIf "gitdir:..." from ~/.gitconfig
+    mock_subprocess_Popen.stdout = b'ssh -i ~/.ssh/work_key\n'
+    wrangler = ghcloneall.RepoWrangler(ssh_command='ssh -o ControlMaster=no')
+    task = wrangler.repo_task(Repo('xyzzy'))
+    assert task.git_env('xyzzy') is None
+
+
+def test_RepoTask_update_shares_ssh_connection(mock_subprocess_Popen):
+    wrangler = ghcloneall.RepoWrangler(ssh_command='ssh -o ControlMaster=no')
+    task = wrangler.repo_task(Repo('xyzzy'))
+    task.update(task.repo, 'xyzzy')
+    pull = mock_subprocess_Popen.commands.index(
+        ['git', 'pull', '-q', '--ff-only'])
+    assert mock_subprocess_Popen.envs[pull]['GIT_SSH_COMMAND'] == (
+        'ssh -o ControlMaster=no'
+    )
+
+
+@pytest.mark.parametrize('partial_clone, shallow_clone, expected_args', [
+    (False, False, []),
+    (True, False, ['--filter=blob:none']),
+    (False, True, ['--depth=1']),
+    (True, True, ['--filter=blob:none', '--depth=1']),
+])
+def test_RepoTask_clone(mock_subprocess_Popen, partial_clone, shallow_clone,
+                        expected_args):
+    progress = ghcloneall.Progress(stream=StringIO())
+    wrangler = ghcloneall.RepoWrangler(progress=progress,
+                                       partial_clone=partial_clone,
+                                       shallow_clone=shallow_clone)
+    task = wrangler.repo_task(Repo('xyzzy'))
+    task.clone(task.repo, 'xyzzy')
+    assert mock_subprocess_Popen.commands == [
+        ['git', 'clone', '-q'] + expected_args +
+        ['git@github.com:test_user/xyzzy.git'],
+    ]
+
+
 def test_RepoTask_run_updates(monkeypatch, ):
-    monkeypatch.setattr(os.path, 'exists', lambda dir: True)
+    monkeypatch.setattr(ghcloneall.RepoWrangler, 'dir_exists',
+                        lambda self, dir: True)
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
     task = wrangler.repo_task(Repo('xyzzy'))
     responses = ['aaaaa', 'bbbbb']
     task.get_current_commit = lambda dir: responses.pop(0)
-    task.get_current_branch = lambda dir: 'master'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(branch='master')
     task.run()
     assert show_ansi_result(buf.getvalue()) == (
         '+ xyzzy (updated)\n'
@@ -983,14 +1410,15 @@ def test_RepoTask_run_updates(monkeypatch, ):
 
 
 def test_RepoTask_run_updates_main(monkeypatch, ):
-    monkeypatch.setattr(os.path, 'exists', lambda dir: True)
+    monkeypatch.setattr(ghcloneall.RepoWrangler, 'dir_exists',
+                        lambda self, dir: True)
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
     task = wrangler.repo_task(Repo('xyzzy', default_branch='main'))
     responses = ['aaaaa', 'bbbbb']
     task.get_current_commit = lambda dir: responses.pop(0)
-    task.get_current_branch = lambda dir: 'main'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(branch='main')
     task.run()
     assert show_ansi_result(buf.getvalue()) == (
         '+ xyzzy (updated)\n'
@@ -1002,12 +1430,35 @@ def test_RepoTask_run_updates_main(monkeypatch, ):
     assert wrangler.n_dirty == 0
 
 
+def test_RepoTask_run_pull_fails(monkeypatch, mock_subprocess_Popen):
+    monkeypatch.setattr(ghcloneall.RepoWrangler, 'dir_exists',
+                        lambda self, dir: True)
+    buf = StringIO()
+    progress = ghcloneall.Progress(stream=buf)
+    wrangler = ghcloneall.RepoWrangler(progress=progress)
+    task = wrangler.repo_task(Repo('xyzzy'))
+    responses = ['aaaaa']
+    task.get_current_commit = lambda dir: responses.pop(0)
+    task.get_status = lambda dir: ghcloneall.RepoStatus(branch='master')
+    mock_subprocess_Popen.stdout = b'fatal: Not possible to fast-forward\n'
+    mock_subprocess_Popen.rc = 128
+    task.run()
+    assert show_ansi_result(buf.getvalue()) == (
+        '+ xyzzy (failed)\n'
+        '    fatal: Not possible to fast-forward\n'
+        '    git pull exited with 128\n'
+        "[####################] 1/0"
+    )
+    assert wrangler.n_updated == 0
+
+
 def raise_exception(*args):
     raise Exception("oh no")
 
 
 def test_RepoTask_run_handles_errors(monkeypatch):
-    monkeypatch.setattr(os.path, 'exists', lambda dir: False)
+    monkeypatch.setattr(ghcloneall.RepoWrangler, 'dir_exists',
+                        lambda self, dir: False)
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
@@ -1026,12 +1477,13 @@ def test_RepoTask_run_handles_errors(monkeypatch):
 
 
 def test_RepoTask_run_in_quiet_mode(monkeypatch):
-    monkeypatch.setattr(os.path, 'exists', lambda dir: True)
+    monkeypatch.setattr(ghcloneall.RepoWrangler, 'dir_exists',
+                        lambda self, dir: True)
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress, quiet=True)
     task = wrangler.repo_task(Repo('xyzzy'))
-    task.get_current_branch = lambda dir: 'master'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(branch='master')
     task.run()
     assert show_ansi_result(buf.getvalue()) == (
         "[####################] 1/0"
@@ -1047,7 +1499,7 @@ def test_RepoTask_aborted(monkeypatch):
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress, quiet=True)
     task = wrangler.repo_task(Repo('xyzzy'))
-    task.get_current_branch = lambda dir: 'master'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(branch='master')
     task.aborted()
     assert show_ansi_result(buf.getvalue()) == (
         '+ xyzzy (aborted)\n'
@@ -1064,11 +1516,9 @@ def test_RepoTask_verify():
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress, verbose=2)
     task = wrangler.repo_task(Repo('xyzzy'))
-    task.get_current_branch = lambda dir: 'boo'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(
+        branch='boo', ahead=1, local_changes=True, staged_changes=True)
     task.get_remote_url = lambda dir: 'root@github.com:test_user/xyzzy'
-    task.has_local_changes = lambda dir: True
-    task.has_staged_changes = lambda dir: True
-    task.has_local_commits = lambda dir: True
     task.verify(task.repo, 'xyzzy')
     # NB: we can see that the output doesn't work right when the terminal
     # width is 80 instead of 100, but I'm not up to fixing it today
@@ -1089,11 +1539,9 @@ def test_RepoTask_verify_main():
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress, verbose=2)
     task = wrangler.repo_task(Repo('xyzzy', default_branch='main'))
-    task.get_current_branch = lambda dir: 'boo'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(
+        branch='boo', ahead=1, local_changes=True, staged_changes=True)
     task.get_remote_url = lambda dir: 'root@github.com:test_user/xyzzy'
-    task.has_local_changes = lambda dir: True
-    task.has_staged_changes = lambda dir: True
-    task.has_local_commits = lambda dir: True
     task.verify(task.repo, 'xyzzy')
     # NB: we can see that the output doesn't work right when the terminal
     # width is 80 instead of 100, but I'm not up to fixing it today
@@ -1114,11 +1562,12 @@ def test_RepoTask_verify_unknown_files():
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress, verbose=2)
     task = wrangler.repo_task(Repo('xyzzy'))
-    task.get_current_branch = lambda dir: 'master'
+    task.get_status = lambda dir: ghcloneall.RepoStatus(
+        branch='master', unknown_files=[
+            '.coverage', 'tags', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i',
+            'j',
+        ])
     task.get_remote_url = lambda dir: 'git@github.com:test_user/xyzzy'
-    task.get_unknown_files = lambda dir: [
-        '.coverage', 'tags', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j',
-    ]
     task.verify(task.repo, 'xyzzy')
     assert show_ansi_result(buf.getvalue()) == (
         '+ xyzzy (unknown files)\n'
@@ -1138,35 +1587,28 @@ def test_RepoTask_verify_unknown_files():
     assert task.dirty
 
 
-def test_RepoTask_branch_name():
-    task = ghcloneall.RepoTask({}, None, None, None)
-    assert task.branch_name('refs/heads/master') == 'master'
-    assert task.branch_name('refs/tags/v0.15') == 'tags/v0.15'
-
-
-def test_RepoTask_call_status_handling(mock_subprocess_Popen):
+def test_RepoTask_check_call_status_handling(mock_subprocess_Popen):
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
     task = wrangler.repo_task(Repo('xyzzy'))
     mock_subprocess_Popen.rc = 1
-    assert task.call(['git', 'diff', '--quiet']) == 1
-    # no failure message should be shown because a non-zero status code is
-    # not a failure!
+    assert not task.check_call(['git', 'fail'])
     assert show_ansi_result(buf.getvalue()) == (
-        '+ xyzzy\n'
+        '+ xyzzy (failed)\n'
+        '    git fail exited with 1\n'
         "[####################] 1/0"
     )
 
 
-def test_RepoTask_call_error_handling(mock_subprocess_Popen):
+def test_RepoTask_check_call_output_is_shown(mock_subprocess_Popen):
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
     task = wrangler.repo_task(Repo('xyzzy'))
     mock_subprocess_Popen.stdout = b'oh no\n'
     mock_subprocess_Popen.rc = 0
-    assert task.call(['git', 'fail', '--please']) == 0
+    assert task.check_call(['git', 'fail', '--please'])
     assert show_ansi_result(buf.getvalue()) == (
         '+ xyzzy\n'
         '    oh no\n'
@@ -1175,56 +1617,26 @@ def test_RepoTask_call_error_handling(mock_subprocess_Popen):
     )
 
 
-def test_RepoTask_call_error_handling_verbose(mock_subprocess_Popen):
-    buf = StringIO()
-    progress = ghcloneall.Progress(stream=buf)
-    wrangler = ghcloneall.RepoWrangler(progress=progress, verbose=1)
-    task = wrangler.repo_task(Repo('xyzzy'))
-    mock_subprocess_Popen.stdout = b'oh no\n'
-    mock_subprocess_Popen.rc = 1
-    assert task.call(['git', 'fail', '--please']) == 1
-    assert show_ansi_result(buf.getvalue()) == (
-        '+ xyzzy\n'
-        '    oh no\n'
-        '    git fail --please exited with 1\n'
-        "[####################] 1/0"
-    )
-
-
-def test_RepoTask_check_call_status_handling(mock_subprocess_Popen):
-    buf = StringIO()
-    progress = ghcloneall.Progress(stream=buf)
-    wrangler = ghcloneall.RepoWrangler(progress=progress)
-    task = wrangler.repo_task(Repo('xyzzy'))
-    mock_subprocess_Popen.rc = 1
-    task.check_call(['git', 'fail'])
-    assert show_ansi_result(buf.getvalue()) == (
-        '+ xyzzy (failed)\n'
-        '    git fail exited with 1\n'
-        "[####################] 1/0"
-    )
-
-
-def test_RepoTask_check_call_output_is_shown(mock_subprocess_Popen):
+def test_RepoTask_check_call_status_and_output(mock_subprocess_Popen):
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
     wrangler = ghcloneall.RepoWrangler(progress=progress)
     task = wrangler.repo_task(Repo('xyzzy'))
     mock_subprocess_Popen.stdout = b'oh no\n'
-    mock_subprocess_Popen.rc = 0
+    mock_subprocess_Popen.rc = 1
     task.check_call(['git', 'fail', '--please'])
     assert show_ansi_result(buf.getvalue()) == (
-        '+ xyzzy\n'
+        '+ xyzzy (failed)\n'
         '    oh no\n'
-        '    git fail exited with 0\n'
+        '    git fail exited with 1\n'
         "[####################] 1/0"
     )
 
 
-def test_RepoTask_check_call_status_and_output(mock_subprocess_Popen):
+def test_RepoTask_check_call_error_handling_verbose(mock_subprocess_Popen):
     buf = StringIO()
     progress = ghcloneall.Progress(stream=buf)
-    wrangler = ghcloneall.RepoWrangler(progress=progress)
+    wrangler = ghcloneall.RepoWrangler(progress=progress, verbose=1)
     task = wrangler.repo_task(Repo('xyzzy'))
     mock_subprocess_Popen.stdout = b'oh no\n'
     mock_subprocess_Popen.rc = 1
@@ -1232,7 +1644,7 @@ def test_RepoTask_check_call_status_and_output(mock_subprocess_Popen):
     assert show_ansi_result(buf.getvalue()) == (
         '+ xyzzy (failed)\n'
         '    oh no\n'
-        '    git fail exited with 1\n'
+        '    git fail --please exited with 1\n'
         "[####################] 1/0"
     )
 
@@ -1271,10 +1683,55 @@ def test_RepoTask_check_output_stderr_without_rc(mock_subprocess_Popen):
     )
 
 
-def test_RepoTask_get_current_branch(mock_subprocess_Popen):
-    task = ghcloneall.RepoTask({}, None, None, None)
-    mock_subprocess_Popen.stdout = b'refs/heads/master\n'
-    assert task.get_current_branch('xyzzy') == 'master'
+def test_RepoTask_get_status(mock_subprocess_Popen):
+    wrangler = ghcloneall.RepoWrangler()
+    task = ghcloneall.RepoTask({}, None, wrangler, None)
+    mock_subprocess_Popen.stdout = (
+        b'# branch.oid 1234567890abcdef1234567890abcdef12345678\n'
+        b'# branch.head master\n'
+    )
+    status = task.get_status('xyzzy')
+    assert status.branch == 'master'
+    assert not status.local_changes
+
+
+def test_RepoStatus_parse():
+    status = ghcloneall.RepoStatus.parse(
+        '# branch.oid 1234567890abcdef1234567890abcdef12345678\n'
+        '# branch.head main\n'
+        '# branch.upstream origin/main\n'
+        '# branch.ab +2 -3\n'
+        '1 .M N... 100644 100644 100644 1234567 1234567 README.rst\n'
+        '? tags\n'
+        '? .coverage\n'
+    )
+    assert status.branch == 'main'
+    assert status.ahead == 2
+    assert status.local_changes
+    assert not status.staged_changes
+    assert status.unknown_files == ['tags', '.coverage']
+
+
+def test_RepoStatus_parse_staged_changes():
+    status = ghcloneall.RepoStatus.parse(
+        '# branch.oid 1234567890abcdef1234567890abcdef12345678\n'
+        '# branch.head (detached)\n'
+        '2 R. N... 100644 100644 100644 1234567 1234567 R100 new\told\n'
+    )
+    assert status.branch == '(detached)'
+    assert status.ahead == 0
+    assert not status.local_changes
+    assert status.staged_changes
+    assert status.unknown_files == []
+
+
+def test_RepoStatus_parse_unmerged():
+    status = ghcloneall.RepoStatus.parse(
+        '# branch.head master\n'
+        'u UU N... 100644 100644 100644 100644 1234567 1234567 1234567 x\n'
+    )
+    assert status.local_changes
+    assert status.staged_changes
 
 
 def test_RepoTask_get_remote_url(mock_subprocess_Popen):
@@ -1319,8 +1776,24 @@ def test_ConcurrentJobQueue():
     assert set(done) == {1, 2, 3}
 
 
+class MockSemaphore:
+    def __init__(self, value):
+        self.value = value
+
+    def acquire(self):
+        # pretend all the workers are stuck: blocking forever until the user
+        # hits ^C
+        if self.value == 0:
+            raise KeyboardInterrupt()
+        self.value -= 1
+
+    def release(self):
+        pass
+
+
 def test_ConcurrentJobQueue_can_be_interrupted(monkeypatch):
-    monkeypatch.setattr(ghcloneall.futures, 'wait', raise_keyboard_interrupt)
+    monkeypatch.setattr(ghcloneall.threading, 'BoundedSemaphore',
+                        MockSemaphore)
     done = []
     with pytest.raises(KeyboardInterrupt):
         with ghcloneall.ConcurrentJobQueue(2) as queue:
@@ -1330,6 +1803,83 @@ def test_ConcurrentJobQueue_can_be_interrupted(monkeypatch):
     assert set(done) == {1, 2, -3}
 
 
+def test_spawn_ssh_control_master(mock_subprocess_Popen):
+    mock_subprocess_Popen.rc = 255
+    ghcloneall.spawn_ssh_control_master('/tmp/socket')
+    assert mock_subprocess_Popen.commands == [
+        ['ssh', '-q', '-O', 'check', '-o', 'ControlPath=/tmp/socket',
+         'git@github.com'],
+        ['ssh', '-q', '-fN', '-o', 'ControlMaster=auto',
+         '-o', 'ControlPersist=600',
+         '-o', 'ControlPath=/tmp/socket', 'git@github.com'],
+    ]
+
+
+def test_spawn_ssh_control_master_user_config(mock_subprocess_Popen):
+    mock_subprocess_Popen.rc = 255
+    ghcloneall.spawn_ssh_control_master()
+    assert mock_subprocess_Popen.commands == [
+        ['ssh', '-q', '-O', 'check', 'git@github.com'],
+        ['ssh', '-q', '-fN', '-o', 'ControlMaster=auto',
+         '-o', 'ControlPersist=600',
+         'git@github.com'],
+    ]
+
+
+def test_spawn_ssh_control_master_already_running(mock_subprocess_Popen):
+    ghcloneall.spawn_ssh_control_master('/tmp/socket')
+    assert mock_subprocess_Popen.commands == [
+        ['ssh', '-q', '-O', 'check', '-o', 'ControlPath=/tmp/socket',
+         'git@github.com'],
+    ]
+
+
+def test_get_core_ssh_command(mock_subprocess_Popen):
+    mock_subprocess_Popen.stdout = b'ssh -i ~/.ssh/work_key\n'
+    assert ghcloneall.get_core_ssh_command('xyzzy') == (
+        'ssh -i ~/.ssh/work_key'
+    )
+    assert mock_subprocess_Popen.commands == [
+        ['git', 'config', '--get', 'core.sshCommand'],
+    ]
+
+
+def test_get_git_ssh_command(monkeypatch):
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    assert ghcloneall.get_git_ssh_command({}) == (
+        'ssh -o BatchMode=yes -o ControlMaster=no'
+        ' -o ControlPath=~/.ssh/ghcloneall-%C'
+    )
+
+
+def test_get_git_ssh_command_windows(monkeypatch):
+    monkeypatch.setattr(sys, 'platform', 'win32')
+    assert ghcloneall.get_git_ssh_command({}) is None
+
+
+def test_get_git_ssh_command_user_override():
+    environ = {'GIT_SSH_COMMAND': 'ssh -i ~/.ssh/work_key'}
+    assert ghcloneall.get_git_ssh_command(environ) is None
+
+
+def test_get_git_ssh_command_user_git_config(
+        monkeypatch, mock_subprocess_Popen):
+    monkeypatch.setattr(sys, 'platform', 'linux')
+    mock_subprocess_Popen.stdout = b'ssh -i ~/.ssh/work_key\n'
+    assert ghcloneall.get_git_ssh_command({}) is None
+
+
+@pytest.mark.parametrize('cpus, expected', [
+    (None, 4),
+    (1, 4),
+    (8, 6),
+    (16, 8),
+])
+def test_default_concurrency(monkeypatch, cpus, expected):
+    monkeypatch.setattr(os, 'cpu_count', lambda: cpus)
+    assert ghcloneall.default_concurrency() == expected
+
+
 def test_main_version(monkeypatch, capsys):
     monkeypatch.setattr(sys, 'argv', ['ghcloneall', '--version'])
     with pytest.raises(SystemExit):
@@ -1381,6 +1931,37 @@ def test_main_no_org_gists(monkeypatch, capsys):
     )
 
 
+def test_main_graphql_without_token(monkeypatch, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'ghcloneall', '--graphql', '--org', 'bar',
+    ])
+    with pytest.raises(SystemExit):
+        ghcloneall.main()
+    assert (
+        'Please specify a GitHub token when using --graphql'
+        in capsys.readouterr().err
+    )
+
+
+def test_main_graphql_from_config_without_token(monkeypatch, capsys,
+                                                config_writes_allowed):
+    config_writes_allowed.write_text(
+        u'[ghcloneall]\n'
+        u'github_org = gtimelog\n'
+        u'graphql = True\n'
+        u'\n'
+    )
+    monkeypatch.setattr(sys, 'argv', [
+        'ghcloneall',
+    ])
+    with pytest.raises(SystemExit):
+        ghcloneall.main()
+    assert (
+        'Please specify a GitHub token when using --graphql'
+        in capsys.readouterr().err
+    )
+
+
 def test_main_run_error_handling_with_private_token(
         monkeypatch, mock_requests_get, capsys):
     monkeypatch.setattr(sys, 'argv', [
@@ -1409,6 +1990,23 @@ def test_main_run_error_handling_no_private_token(monkeypatch, capsys):
     )
 
 
+def test_main_disables_git_terminal_prompt(monkeypatch, mock_requests_get):
+    monkeypatch.setattr(sys, 'argv', ['ghcloneall', '--user', 'mgedmin'])
+    mock_requests_get.update(mock_multi_page_api_responses(
+        url='https://api.github.com/users/mgedmin/repos', pages=[[]]))
+    ghcloneall.main()
+    assert os.environ['GIT_TERMINAL_PROMPT'] == '0'
+
+
+def test_main_keeps_user_git_terminal_prompt(monkeypatch, mock_requests_get):
+    monkeypatch.setattr(sys, 'argv', ['ghcloneall', '--user', 'mgedmin'])
+    monkeypatch.setenv('GIT_TERMINAL_PROMPT', '1')
+    mock_requests_get.update(mock_multi_page_api_responses(
+        url='https://api.github.com/users/mgedmin/repos', pages=[[]]))
+    ghcloneall.main()
+    assert os.environ['GIT_TERMINAL_PROMPT'] == '1'
+
+
 def test_main_run(monkeypatch, mock_requests_get, capsys):
     monkeypatch.setattr(sys, 'argv', [
         'ghcloneall', '--user', 'mgedmin', '--concurrency=1',
@@ -1431,6 +2029,25 @@ def test_main_run(monkeypatch, mock_requests_get, capsys):
     )
 
 
+def test_main_run_jobs_alias(monkeypatch, mock_requests_get, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'ghcloneall', '--user', 'mgedmin', '-j1',
+    ])
+    mock_requests_get.update(mock_multi_page_api_responses(
+        url='https://api.github.com/users/mgedmin/repos',
+        pages=[
+            [
+                repo('ghcloneall'),
+            ],
+        ],
+    ))
+    ghcloneall.main()
+    assert show_ansi_result(capsys.readouterr().out) == (
+        '+ ghcloneall (new)\n'
+        '1 repositories: 0 updated, 1 new, 0 dirty.'
+    )
+
+
 def test_main_run_with_token(monkeypatch, mock_requests_get, capsys):
     monkeypatch.setattr(sys, 'argv', [
         'ghcloneall', '--user', 'mgedmin', '--concurrency=1',
@@ -1456,6 +2073,30 @@ def test_main_run_with_token(monkeypatch, mock_requests_get, capsys):
     )
 
 
+def test_main_run_graphql(monkeypatch, mock_requests_post, capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'ghcloneall', '--user', 'mgedmin', '--concurrency=1',
+        '--github-token', 'fake-token', '--graphql',
+    ])
+    mock_requests_post.update(mock_graphql_responses(
+        owner='mgedmin',
+        owner_type='user',
+        pages=[
+            [
+                graphql_repo('ghcloneall'),
+                graphql_repo('experiment', isArchived=True),
+                graphql_repo('xyzzy', isPrivate=True),
+            ],
+        ],
+    ))
+    ghcloneall.main()
+    assert show_ansi_result(capsys.readouterr().out) == (
+        '+ ghcloneall (new)\n'
+        '+ xyzzy (new)\n'
+        '2 repositories: 0 updated, 2 new, 0 dirty.'
+    )
+
+
 def test_main_run_with_mismatched_token(monkeypatch, mock_requests_get,
                                         capsys):
     monkeypatch.setattr(sys, 'argv', [
@@ -1539,6 +2180,28 @@ def test_main_run_gists(monkeypatch, mock_requests_get, capsys):
     )
 
 
+def test_main_run_gists_ignores_graphql(monkeypatch, mock_requests_get,
+                                        capsys):
+    monkeypatch.setattr(sys, 'argv', [
+        'ghcloneall', '--user', 'mgedmin', '--gists', '--concurrency=1',
+        '--graphql',
+    ])
+    mock_requests_get.update(mock_multi_page_api_responses(
+        url='https://api.github.com/users/mgedmin/gists',
+        extra='',
+        pages=[
+            [
+                gist('1234'),
+            ],
+        ],
+    ))
+    ghcloneall.main()
+    assert show_ansi_result(capsys.readouterr().out) == (
+        '+ 1234 (new)\n'
+        '1 repositories: 0 updated, 1 new, 0 dirty.'
+    )
+
+
 @pytest.fixture()
 def config_writes_allowed(mock_config_filename, monkeypatch, tmp_path):
     monkeypatch.chdir(tmp_path)
@@ -1642,6 +2305,24 @@ def test_main_init_filter_flags(monkeypatch, capsys, config_writes_allowed):
     )
 
 
+def test_main_init_graphql(monkeypatch, capsys, config_writes_allowed):
+    monkeypatch.setattr(sys, 'argv', [
+        'ghcloneall', '--init', '--org', 'gtimelog', '--github-token',
+        'UNITTEST', '--graphql',
+    ])
+    ghcloneall.main()
+    assert capsys.readouterr().out == (
+        'Wrote .ghcloneallrc\n'
+    )
+    assert config_writes_allowed.read_text() == (
+        '[ghcloneall]\n'
+        'github_org = gtimelog\n'
+        'github_token = UNITTEST\n'
+        'graphql = True\n'
+        '\n'
+    )
+
+
 def test_main_reads_config_file(monkeypatch, capsys, config_writes_allowed):
     config_writes_allowed.write_text(
         u'[ghcloneall]\n'